@@ -1,13 +1,62 @@
-import network, sys, time
+import gc, micropython, network, sys, time
 import random
-from umqtt import simple #TODO: investigate umqtt.robust
+from array import array
+from umqtt import simple
 import usyslog
-from pm1006 import PM1006
+from pm1006 import PM1006, median
 
 import config
 print()
 
+# The application, not a library, sizes this process-wide buffer; it lets exceptions still be
+# reported when the heap is exhausted (or in an interrupt handler)
+micropython.alloc_emergency_exception_buf(100)
+
 VNOTFOUND = const(-1)
+_READINGS = const(120) # we get a fresh batch of readings every ~30 seconds, so always keep one hour
+_WINDOW = const(10) # the most readings we need at once, apart from the hourly mean
+_PUBLISH_MS = const(45000)
+_MQTT_BACKOFF_MS = const(300000) # when the broker keeps failing, back off (doubling each time) to this
+
+# Config values never change, so look them up once rather than on every iteration
+wifi_network = config.wifi_network
+wifi_password = config.wifi_password
+mqtt_topic_pmvt = config.mqtt_topic_pmvt
+pm1006_filter = config.pm1006_filter
+pm1006_smooth = config.pm1006_smooth
+wifi_repr = repr((wifi_network, '****' if wifi_password else wifi_password)) # for logging
+
+# umqtt writes the topic straight to the socket, so encode it once here rather than on every publish
+if isinstance(mqtt_topic_pmvt, str):
+    mqtt_topic_pmvt = mqtt_topic_pmvt.encode()
+
+# Turn a constant adjustment into a filter function, so the loop only has to check for None
+if pm1006_filter is not None and not callable(pm1006_filter):
+    pm1006_filter = lambda values, adjust=pm1006_filter: [adjust + v for v in values]
+
+# For exponential smoothing, also precompute the weight given to each new value
+if pm1006_smooth is None or pm1006_smooth is True or pm1006_smooth is False or callable(pm1006_smooth):
+    pm1006_smooth_new = None
+else:
+    assert (pm1006_smooth >= 0 and pm1006_smooth < 1)
+    pm1006_smooth_new = 1 - pm1006_smooth
+
+# Long-lived objects are allocated as early as possible, before anything transient
+# (like connecting to the network) has a chance to fragment the heap
+
+# Preallocated ring buffer of unboxed floats, so that it never grows or fragments the heap
+readings = array('f', [VNOTFOUND] * _READINGS)
+readings_head = 0 # the next slot to be overwritten
+readings_sum = 0 # running total of all the readings that aren't padding, for the hourly mean
+readings_count = 0
+
+# Preallocated scratch space for the recent windows of readings, see recent_readings()
+window = array('f', bytes(4 * _WINDOW))
+window_mv = memoryview(window)
+
+# Preallocated buffer for the published value, see format_fixed2()
+payload = bytearray(16)
+payload_mv = memoryview(payload)
 
 # Extend the basic UMQTT client with a couple of helpers to keep our own code cleaner
 class MQTTClient(simple.MQTTClient):
@@ -19,24 +68,73 @@ class MQTTClient(simple.MQTTClient):
     def disconnect(self):
         try: super().disconnect()
         except: pass
+        if self.sock is not None: # super().disconnect() doesn't close the socket if sending DISCONNECT fails
+            try: self.sock.close()
+            except: pass
         self.sock = None
 
 # Helper routine to keep our own code cleaner. NOTE: no timeout, may hang indefinitely
 def wlan_connect():
-    # wlan.status start off 0, then 1 while trying to connect, finally 5 when connected
+    # wlan.status start off STAT_IDLE, then STAT_CONNECTING while trying to connect, finally STAT_GOT_IP
+    # (i.e. DHCP has finished, so there's no need to wait any longer "just in case")
     while True:
         wlan.active(True)
-        wlan.connect(config.wifi_network, config.wifi_password)
-        for i in range(0, 10):
-            time.sleep(1)
-            if wlan.isconnected():
-                time.sleep(5) #TODO: check if this is actually necessary
+        wlan.connect(wifi_network, wifi_password)
+        for i in range(0, 100): # approx. 10 seconds
+            time.sleep_ms(100)
+            status = wlan.status()
+            if status == network.STAT_GOT_IP:
                 return True
+            if status != network.STAT_CONNECTING and status != network.STAT_IDLE:
+                # failed (wrong password, no AP found, ...), so wait out the rest of the attempt before trying again,
+                # rather than hammering the radio (and the log) when the config is wrong
+                time.sleep_ms(100 * (99 - i))
+                break
+
+# Helper routine to copy the last n readings (most recent first) into the scratch space, dropping any
+# padding; returns a memoryview that is only valid until the next call, rather than a new list every time
+def recent_readings(n):
+    count = 0
+    for i in range(1, n + 1):
+        v = readings[(readings_head - i) % _READINGS]
+        if v != VNOTFOUND:
+            window[count] = v
+            count += 1
+    return window_mv[:count]
+
+# Helper routine to format a value to two decimal places, like '%.2f' but without
+# allocating a new string every time; returns a memoryview that is only valid until the next call
+def format_fixed2(value):
+    if not (0 <= value < 1e13): # negative, too big for the buffer, NaN or inf; can't happen with the defaults
+        return '%.2f' % (value,)
+    n = int(value * 100 + 0.5)
+    i = len(payload)
+    for d in range(0, 3): # two decimal places, and at least one digit before the point
+        if d == 2:
+            i -= 1
+            payload[i] = 0x2E # '.'
+        i -= 1
+        payload[i] = 0x30 + n % 10
+        n //= 10
+    while n and i > 0:
+        i -= 1
+        payload[i] = 0x30 + n % 10
+        n //= 10
+    return payload_mv[i:]
 
 # Start with local logging
 log = usyslog.Handler(config.syslog_address, usyslog.LOG_CONSOLE,
                       hostname=config.machine_id, ident='vindriktning',
                       level=usyslog.DEBUG, option=usyslog.LOG_PERROR|usyslog.LOG_CONS)
+debugging = log.isEnabledFor(usyslog.DEBUG) # if not, don't waste time formatting debug messages
+
+# Set up the PM1006 sensor
+pm1006 = PM1006(config.pm1006_rxpin, loghandler=log, logdebug=debugging)
+
+# Set up UMQTT
+mqtt = MQTTClient(config.mqtt_client_id, config.mqtt_broker,
+                  user=config.mqtt_username, password=config.mqtt_password,
+                  ssl=False) # FIXME: test with SSL, add config option (also port number)
 
 # Connect to the network
 network.WLAN(network.AP_IF).active(False)
@@ -50,111 +148,120 @@ except Exception as e:
 log.setFacility(usyslog.LOG_DAEMON)
 log.info('Started')
 
-# Set up the PM1006 sensor
-pm1006 = PM1006(config.pm1006_rxpin, loghandler=log)
-
-# Set up UMQTT
-mqtt = MQTTClient(config.mqtt_client_id, config.mqtt_broker,
-                  user=config.mqtt_username, password=config.mqtt_password,
-                  ssl=False) # FIXME: test with SSL, add config option (also port number)
-
 ##
 ## MAIN LOOP
 ##
 
 random.seed(None)
 
-#next_publish_time = time.time() + 100 + random.getrandbits(8) # approx. two to six minutes
-next_publish_time = time.time() + 45
+# Collect early and predictably (rather than when an allocation fails on a fragmented heap)
+gc.threshold((gc.mem_free() + gc.mem_alloc()) // 4)
 
-readings = []
+# ticks are monotonic (and cheap), whereas time.time() jumps about if the RTC is ever set
+#next_publish_ticks = time.ticks_add(time.ticks_ms(), (100 + random.getrandbits(8)) * 1000) # approx. two to six minutes
+next_publish_ticks = time.ticks_add(time.ticks_ms(), _PUBLISH_MS)
+mqtt_last_success = time.ticks_ms()
+mqtt_backoff = _PUBLISH_MS
 
 last_pmvt = None
 
+wlan_reported = False # whether we've logged that the network is up
+
+# Bind the methods used on every iteration, rather than looking them up (and allocating a bound method) each time
+read_raw = pm1006.read_raw
+log_debug = log.debug
+log_info = log.info
+wlan_isconnected = wlan.isconnected
+mqtt_publish = mqtt.publish
+ticks_ms = time.ticks_ms
+ticks_diff = time.ticks_diff
+
+gc.collect() # tidy up after startup, before the long-running part
+
 while True:
 
+    gc.collect() # we're about to block on the UART anyway
+
     try:
 
         ## CALCULATE VNOW AND UPDATE READINGS
 
-        vnow = pm1006.read_raw()
+        vnow = read_raw()
         if vnow is None:
             vnow = []
 
-        if config.pm1006_filter is None:
-            pass
-        elif callable(config.pm1006_filter):
-            vnow = config.pm1006_filter(vnow) # must return something [indexable] and .sort()able (TLDR: a list)
-        else: # assume a constant adjustment
-            vnow = [config.pm1006_filter + v for v in vnow]
+        if pm1006_filter is not None:
+            vnow = pm1006_filter(vnow) # must return something [indexable] and mutable (TLDR: a list)
+
+        if readings[readings_head] != VNOTFOUND: # about to be overwritten, so take it out of the running total
+            readings_sum -= readings[readings_head]
+            readings_count -= 1
 
         if len(vnow):
-            vnow.sort()
-            vnow = vnow[len(vnow)//2] # median
+            vnow = median(vnow)
             # you can effectively noop the median if your filter returns an array with one element
             # e.g. pm1006_filter = lambda values: [sum(values)/len(values)] if len(values) else []
             vnow = max(0, vnow) # clamp
-            readings.append(vnow)
+            readings[readings_head] = vnow
+            readings_sum += readings[readings_head] # as stored, so it's exactly what gets subtracted later
+            readings_count += 1
         else:
             vnow = None
-            readings.append(VNOTFOUND)
+            readings[readings_head] = VNOTFOUND
 
-        readings = readings[-120:] # we get a fresh batch of readings every ~30 seconds, so always keep one hour
+        readings_head = (readings_head + 1) % _READINGS
+        if readings_head == 0: # once an hour, recalculate the running total so rounding errors can't build up
+            readings_sum = sum(v for v in readings if v != VNOTFOUND)
 
         ## CALCULATE OTHER VALUES
 
-        v90s = readings[-3:] # no .copy() needed; this is 3 batches (so median will filter out one extreme batch)
-        v90s = [v for v in v90s if v != VNOTFOUND] # drop any negative values used as padding
+        v90s = recent_readings(3) # this is 3 batches (so median will filter out one extreme batch)
         if len(v90s):
-            v90s.sort()
-            v90s = v90s[len(v90s)//2] # median (of medians)
+            v90s = median(v90s) # (of medians)
         else:
             v90s = None
 
-        v05m = readings[-10:] # no .copy() needed; this is 10 batches (~5 minutes)
-        v05m = [v for v in v05m if v != VNOTFOUND] # drop any negative values used as padding
+        v05m = recent_readings(_WINDOW) # this is 10 batches (~5 minutes)
         if len(v05m):
-            v05m.sort()
-            v05m = v05m[len(v05m)//2] # median (of medians)
+            v05m = median(v05m) # (of medians)
         else:
             v05m = None
 
-        v60m = readings.copy()
-        v60m = [v for v in v60m if v != VNOTFOUND] # drop any negative values used as padding
-        if len(v60m):
-            v60m.sort()
-            v60m = sum(v60m) / len(v60m) # mean (of medians)
+        if readings_count:
+            v60m = readings_sum / readings_count # mean (of medians)
         else:
             v60m = None
 
-        log.debug('vnow=%s / v90s=%s / v05m=%s / v60m=%s' % (repr(vnow),repr(v90s),repr(v05m),repr(v60m)))
+        if debugging:
+            log_debug('vnow=%s / v90s=%s / v05m=%s / v60m=%s', vnow, v90s, v05m, v60m)
 
         ## TIME
 
-        if time.time() < next_publish_time:
+        if ticks_diff(next_publish_ticks, ticks_ms()) > 0:
             continue
-#        next_publish_time = time.time() + 300 + random.getrandbits(6) # approx. five to six minutes
-        next_publish_time = time.time() + 45
+#        next_publish_ticks = time.ticks_add(ticks_ms(), (300 + random.getrandbits(6)) * 1000) # approx. five to six minutes
+        next_publish_ticks = time.ticks_add(ticks_ms(), _PUBLISH_MS)
 
         ## PMVT
 
         pmvt = v90s
 
-        if config.pm1006_smooth is None:
+        if pm1006_smooth is None:
             pass
-        elif config.pm1006_smooth is False:
+        elif pm1006_smooth is False:
             pass
         elif last_pmvt is None:
             (pmvt, last_pmvt) = (pmvt, pmvt)
         elif pmvt is None:
             (pmvt, last_pmvt) = (last_pmvt, pmvt)
-        elif callable(config.pm1006_smooth):
-            (pmvt, last_pmvt) = (config.pm1006_smooth(pmvt, last_pmvt), pmvt)
-        elif config.pm1006_smooth is True: # mean
-            (pmvt, last_pmvt) = ((pmvt + last_pmvt) / 2.0, pmvt)
+        elif callable(pm1006_smooth):
+            (pmvt, last_pmvt) = (pm1006_smooth(pmvt, last_pmvt), pmvt)
+        elif pm1006_smooth is True: # mean
+            (pmvt, last_pmvt) = ((pmvt + last_pmvt) * 0.5, pmvt)
+        elif pm1006_smooth == 0: # exponential smoothing, but a no-op
+            last_pmvt = pmvt
         else: # exponential smoothing
-            assert (config.pm1006_smooth >= 0 and config.pm1006_smooth < 1)
-            pmvt = (1 - config.pm1006_smooth) * pmvt + config.pm1006_smooth * last_pmvt
+            pmvt = last_pmvt + pm1006_smooth_new * (pmvt - last_pmvt) # i.e. new*pmvt + smooth*last, with one multiply
             last_pmvt = pmvt
 
         if pmvt is None:
@@ -162,40 +269,53 @@ while True:
 
         ## CONNECT
 
-        if not wlan.isconnected():
-            log.info('Connecting to network %s' % (repr((config.wifi_network, '****' if config.wifi_password else config.wifi_password)),))
+        if not wlan_isconnected():
+            wlan_reported = False
+            log_info('Connecting to network %s', wifi_repr)
             try:
                 wlan_connect()
-                log.debug('Connected to network %s' % (repr(wlan.ifconfig()),))
+                wlan_reported = True
+                if debugging:
+                    log_debug('Connected to network %s', wlan.ifconfig())
             except Exception as e:
                 log.exception(e, ' while connecting to network')
-        else:
-            log.debug('Already connected to network (wlan.status=%s)' % (repr(wlan.status()),))
-
-        if not wlan.isconnected():
-            log.debug('Ignoring broker while not connected to network')
-            continue
-        else:
-            log.info('Connecting to broker %s' % (repr((mqtt.server, mqtt.port)),))
+                log_debug('Ignoring broker while not connected to network')
+                mqtt.disconnect() # the connection to the broker won't have survived anyway
+                continue
+            mqtt.disconnect() # nor if the network dropped out since the last publish
+        elif not wlan_reported: # only log changes, not every check
+            wlan_reported = True
+            if debugging:
+                log_debug('Already connected to network (wlan.status=%s)', wlan.status())
+
+        # wlan_connect() only returns once connected, so there's no need to check the network again here
+        if not mqtt.isconnected(): # otherwise stay connected between publishes
+            log_info('Connecting to broker %s:%s', mqtt.server, mqtt.port)
             try:
                 mqtt.connect() # default is clean_session=True
-                log.debug('Connected to broker %s' % (repr(mqtt.sock),))
+                if debugging:
+                    log_debug('Connected to broker %s', mqtt.sock)
             except Exception as e:
                 log.exception(e, ' while connecting to broker')
+                mqtt.disconnect() # connect() leaves .sock set even if it fails
+                mqtt_backoff = min(mqtt_backoff * 2, _MQTT_BACKOFF_MS)
+                next_publish_ticks = time.ticks_add(ticks_ms(), mqtt_backoff)
                 continue
 
         ## PUBLISH
 
-        if config.mqtt_topic_pmvt is not None:
-            log.info('Publishing %s' % (repr((config.mqtt_topic_pmvt, pmvt))))
+        if mqtt_topic_pmvt is not None:
+            log_info('Publishing %s to %s', pmvt, mqtt_topic_pmvt)
             try:
-                mqtt.publish(config.mqtt_topic_pmvt, '%.2f' % (pmvt,), retain=True)
-                log.debug('Publish success!')
-            except:
-                log.exception(e, ' while publishing (%d seconds since last success)', time.time() - mqtt_last_success)
-
-        log.debug('Disconnecting from broker')
-        mqtt.disconnect()
+                mqtt_publish(mqtt_topic_pmvt, format_fixed2(pmvt), retain=True)
+                mqtt_last_success = ticks_ms()
+                mqtt_backoff = _PUBLISH_MS
+                log_debug('Publish success!')
+            except Exception as e:
+                log.exception(e, ' while publishing (%d seconds since last success)', ticks_diff(ticks_ms(), mqtt_last_success) // 1000)
+                mqtt.disconnect() # start afresh next time
+                mqtt_backoff = min(mqtt_backoff * 2, _MQTT_BACKOFF_MS)
+                next_publish_ticks = time.ticks_add(ticks_ms(), mqtt_backoff)
 
     except Exception as e:
         log.exception('UNHANDLED EXCEPTION', e)
@@ -1,81 +1,149 @@
 from machine import Pin, SoftUART
+from array import array
+import micropython
+from micropython import const
+
+_FRAME = const(20) # bytes per frame
+_MAGIC = const(0x16110B) # every frame starts with 22, 17, 11
+_DF3 = const(5) # offset of the PM2.5 reading (DF3,DF4) within a frame
+_BUFFER = const(12 * _FRAME) # room for 12 frames (240 bytes), so a long burst is never truncated
+_BAUDRATE = const(9600)
+_TIMEOUT_MS = const(3000)
+_READ_RETRIES = const(20) # consecutive short reads before giving up
 
 class _PassLogHandler:
-    def debug(self, msg):
+    def debug(self, msg, *args):
         pass
-    def info(self, msg):
+    def info(self, msg, *args):
         pass
-    def warning(self, msg):
+    def warning(self, msg, *args):
         pass
-    def error(self, msg):
+    def error(self, msg, *args):
         pass
-    def critical(self, msg):
+    def critical(self, msg, *args):
         pass
 
 class _PrintLogHandler:
-    def debug(self, msg):
-        print(msg)
-    def info(self, msg):
-        print(msg)
-    def warning(self, msg):
-        print(msg)
-    def error(self, msg):
-        print(msg)
-    def critical(self, msg):
-        print(msg)
+    def debug(self, msg, *args):
+        print(msg % args if args else msg)
+    def info(self, msg, *args):
+        print(msg % args if args else msg)
+    def warning(self, msg, *args):
+        print(msg % args if args else msg)
+    def error(self, msg, *args):
+        print(msg % args if args else msg)
+    def critical(self, msg, *args):
+        print(msg % args if args else msg)
+
+# The handlers have no state, so every PM1006 can share the same one
+_pass_log = _PassLogHandler()
+_print_log = _PrintLogHandler()
+
+# Copies the PM2.5 reading (DF3 * 256 + DF4) of each valid frame in buf[:n] into out, returning how many
+# If a frame is bad (e.g. we missed a symbol) then rather than losing the rest of the buffer, we resync on magic
+# Viper compiles this to native code, so the whole scan runs without the interpreter (or any allocation)
+@micropython.viper
+def _parse_frames(buf: ptr8, n: int, out: ptr16) -> int:
+    count = 0
+    offset = 0
+    while offset + _FRAME <= n:
+        if ((buf[offset] << 16) | (buf[offset + 1] << 8) | buf[offset + 2]) == _MAGIC:
+            s = 0
+            for i in range(offset, offset + _FRAME):
+                s += buf[i]
+            if (s & 0xff) == 0: # the checksum byte makes the sum of a valid frame zero
+                out[count] = (buf[offset + _DF3] << 8) | buf[offset + _DF3 + 1]
+                count += 1
+                offset += _FRAME
+                continue
+        offset += 1
+    return count
+
+# Returns the same value as values.sort(); values[len(values)//2] (i.e. the upper median)
+# but selects it in place (quickselect), which is O(n) on average rather than O(n log n)
+# NOTE: values must be non-empty, and will be partially reordered
+def median(values):
+    # small windows (like the 90 second one) are common, and simple enough to do directly
+    if len(values) < 3: # i.e. the larger of two
+        return max(values[0], values[-1])
+    if len(values) == 3:
+        (a, b, c) = (values[0], values[1], values[2])
+        return max(min(a, b), min(max(a, b), c))
+    k = len(values) // 2
+    lo = 0
+    hi = len(values) - 1
+    while lo < hi:
+        pivot = values[(lo + hi) // 2]
+        i = lo
+        j = hi
+        while i <= j:
+            while values[i] < pivot:
+                i += 1
+            while values[j] > pivot:
+                j -= 1
+            if i <= j:
+                (values[i], values[j]) = (values[j], values[i])
+                i += 1
+                j -= 1
+        if k <= j:
+            hi = j
+        elif k >= i:
+            lo = i
+        else:
+            break
+    return values[k]
 
 class PM1006:
     def __init__(self, rxpin, **kwargs):
         log = kwargs.get('loghandler', None)
         if log is None or log is False:
-            self._log = _PassLogHandler()
+            self._log = _pass_log
         elif log is True:
-            self._log = _PrintLogHandler()
+            self._log = _print_log
         else:
             self._log = log
 
+        # only format debug messages if they're wanted, because most handlers just throw them away
+        # (the caller knows its own handler's levels, so it can tell us, otherwise we guess)
+        self._debug = kwargs.get('logdebug', self._log is not _pass_log)
+
         # tx is required but not used, doesn't even need to be connected
         # timeout must be over 2 seconds to capture a full Vindriktning cycle with one read()
         # but the smaller the timeout the better to maximise time left for non-UART stuff
         # this variable must start with double underscore because of a Thonny bug
-        self._uart = SoftUART(baudrate=9600, rx=Pin(rxpin), tx=Pin(0), timeout=3000)
+        self._uart = SoftUART(baudrate=_BAUDRATE, rx=Pin(rxpin), tx=Pin(0), timeout=_TIMEOUT_MS)
+
+        # read into the same buffer every time, rather than allocating a new one for every read()
+        self._buf = bytearray(_BUFFER)
+        self._values = array('H', bytes(2 * (_BUFFER // _FRAME)))
 
     def read_raw(self):
         self._log.debug('Waiting for UART')
         noreadcounter = 0
         while True: #TODO: timer argument to break out of this
             try:
-                data = self._uart.read()
+                n = self._uart.readinto(self._buf)
             except Exception as e:
-                self._log.critical('Exception %s:%s while reading UART' % (type(e).__name__, e.args))
+                self._log.critical('Exception %s:%s while reading UART', type(e).__name__, e.args)
                 return None
-            if data is None or len(data) < 20:
+            if n is None or n < _FRAME:
                 noreadcounter += 1
-                if noreadcounter >= 20:
+                if noreadcounter >= _READ_RETRIES:
                     self._log.error('UART reading failed')
                     return None
                 continue
             break
-        self._log.debug('Read from UART (%d bytes)' % (len(data),))
-
-        raw = []
-        for offset in range(0,len(data),20):
-            if offset+20 > len(data):
-                self._log.warning('Partial frame at %d, ignoring reading' % (offset,))
-                break
-            if data[offset+0] != 22 or data[offset+1] != 17 or data[offset+2] != 11:
-                # probably missed a symbol; in theory, we could resync on magic
-                self._log.warning('Bad magic at %d, ignoring reading' % (offset,))
-                continue # or break?
-            if sum(data[offset:offset+20]) % 256 != 0:
-                self._log.warning('Bad checksum at %d, ignoring reading' % (offset,))
-                continue
-            df3 = data[offset+5]
-            df4 = data[offset+6]
-            df3df4 = df3 * 256 + df4
-            raw.append(df3df4)
+        if self._debug:
+            self._log.debug('Read from UART (%d bytes)', n)
 
-        self._log.debug('UART values are %s' % (repr(raw),))
+        count = _parse_frames(self._buf, n, self._values)
+        if count * _FRAME < n:
+            # partial frames, or garbage skipped while resyncing
+            self._log.warning('Ignored %d of %d bytes from UART', n - count * _FRAME, n)
+        raw = list(self._values[:count]) # a list, as always, so that callers (and filters) can .sort() it etc.
+
+        if self._debug:
+            self._log.debug('UART values are %s', raw)
 
         return raw
 
@@ -92,11 +160,10 @@ class PM1006:
             self._log.error('UART values not found')
             return None
 
-        raw.sort()
-
-        one = raw[len(raw)//2] # median
+        one = median(raw)
 
-        self._log.debug('UART value is %s' % (repr(raw),))
+        if self._debug:
+            self._log.debug('UART value is %s', raw)
 
         return one
 
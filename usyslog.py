@@ -68,10 +68,15 @@ tail -f /var/log/remote.log
 # heap size increased by ~6KB on ESP8266, as reported by
 # import gc ; gc.collect() ; gc.mem_alloc() ; import usyslog ; z=usyslog.Handler() ; gc.collect() ; gc.mem_alloc()
 # import gc,micropython ; gc.collect() ; micropython.mem_info() ; import usyslog ; z=usyslog.Handler() ; gc.collect() ; micropython.mem_info()
+# each log call still allocates a little (the formatted message, and its encoding), so consider setting
+# gc.threshold() in your application, so that collections are small and regular rather than large and sudden
 
 from micropython import const
 import usocket # essential
+import gc
 import sys # if you *really* don't want to import sys, only minor code changes are needed
+import time
+import errno
 
 RFC = const(5424) # const(3164) or const(5424), might need to enable the code section in _syslog4() below
 
@@ -143,8 +148,14 @@ _severityprefixes = (
     '[debug] ',		# [7]
 )
 
+# the same, pre-encoded for writing to perror
+_severityprefixes_b = tuple(p.encode('utf-8') for p in _severityprefixes)
+
 _INTERNAL_ERROR_SEVERITY = const(LOG_ERR)
 
+# RFC5424 says all receivers must accept 480 octets, anything longer might be truncated anyway
+_PACKET_SIZE = const(480)
+
 ######## Implement (most of) the syslog wrapper API ...
 
 # This is the state shared between all (non-Handler) calls to this module.
@@ -165,15 +176,40 @@ _state = {
 # these are shared so that this module can only ever use one socket
 # (this is a *syslog* module, not a generic network-logging module)
 _address = False # magic value, meaning no network logging
+_handlers = 0 # Handlers that haven't been closed, so that closing one doesn't close the socket under the others
 _info = None
+_info_ticks = 0 # when _info was looked up
 _sock = None
 
+# getaddrinfo() blocks (for tens or hundreds of ms), so cache the result, but not forever in case DHCP/DNS changes
+#EXTENSION: conf(dns_ttl_ms=...) to change this, where 0 means never look it up again (unless sending fails)
+_DEFAULT_DNS_TTL_MS = const(300000)
+_dns_ttl_ms = _DEFAULT_DNS_TTL_MS
+
+# every packet is assembled in the same buffer, rather than concatenating a new one for each message
+_packet = bytearray(_PACKET_SIZE)
+_packet_mv = memoryview(_packet)
+
+# the encoded '<PRI>1 ' at the start of each packet, filled in as each facility|severity is first used
+_priprefixes = {}
+
 ## sample timestamp function to use as your callback
+# (time is already imported at the top of this module, so there's no need to import it on every call)
 #def rfc5424timestamp(state): # updating 'state' has undefined behaviour
-#    import time
 #    t = time.gmtime()
 #    return '%04d-%02d-%02dT%02d:%02d:%02dZ' % (t[0], t[1], t[2], t[3], t[4], t[5])
 
+# the part of an RFC5424 packet after the timestamp only changes with the hostname or ident,
+# so it's built (and encoded) here when they're set, rather than for every message
+def _make_header(state):
+    hostname = str(state['hostname'])
+    ident = str(state['ident']).replace(' ','_') #EXTENSION: that .replace()
+    if hostname == '':
+        hostname = '-'
+    if ident == '':
+        ident = '-'
+    return (' %s %s - - - ' % (hostname, ident)).encode('utf-8')
+
 # note that if any value is None, then the associated state key will not be updated
 # this allows us to pass in a method's named arguments with minimal processing
 def _update_state(state, **kwargs):
@@ -182,27 +218,54 @@ def _update_state(state, **kwargs):
             pass
         elif k == 'address':
             global _address, _info, _sock
-            _address = kwargs['address']
-            _info = None
-            _sock = None
+            a = kwargs['address']
+            #EXTENSION: tuple not required, can just use a string and assume the port number
+            if a is False:
+                a = False
+            elif isinstance(a, tuple):
+                a = (a[0], a[1])
+            else:
+                a = (a, SYSLOG_UDP_PORT)
+            if a != _address: # the socket is shared by every Handler, so leave it alone unless it has to change
+                _address = a
+                _close() # the old socket, and the old address's lookup
+                if _address is not False:
+                    # the socket doesn't need the network to be up (unlike getaddrinfo), so create it now
+                    # rather than on the first message; if this fails, _syslog4() will try again anyway
+                    try: _sock = _new_socket()
+                    except OSError: pass
+        elif k == 'dns_ttl_ms':
+            global _dns_ttl_ms
+            _dns_ttl_ms = int(kwargs['dns_ttl_ms'])
+        elif k == 'facility' or k == 'option' or k == 'logmask' or k == 'conmask' or k == 'level':
+            state[k] = int(kwargs[k]) # once here, rather than every time they're used
         else:
             state[k] = kwargs[k]
+    if 'hostname' in kwargs or 'ident' in kwargs:
+        state['_header'] = _make_header(state)
+    if 'timestamp' in kwargs:
+        state['_ts_callable'] = callable(state['timestamp'])
+        if not state['_ts_callable']:
+            state['timestamp'] = str(state['timestamp']) # once here, so that _syslog4() can just encode it
+
+_state['_header'] = _make_header(_state)
+_state['_ts_callable'] = False
 
 #EXTENSION: how can you not have something called syslog.conf ?
-def conf(**kwargs): # currently the only way to set 'address' 'hostname' 'conmask' 'perror' 'timestamp' in the basic API
+def conf(**kwargs): # currently the only way to set 'address' 'hostname' 'conmask' 'perror' 'timestamp' 'dns_ttl_ms' in the basic API
     _update_state(_state, **kwargs)
 
 # not a great API (which is why the similar one for conmask is disabled below)
 # this is here for compatibility, if you just want to set the value use conf() instead
 def setlogmask(mask):
-    omask = state['logmask']
+    omask = _state['logmask']
     if mask is not None and mask != 0: # as per the C API
-        _state['logmask'] = mask
+        _state['logmask'] = int(mask)
     return omask
 
 #EXTENSION: is it actually an extension if it's disabled?
 #def setconmask(mask):
-#    omask = state['conmask']
+#    omask = _state['conmask']
 #    if mask is not None and mask != 0: # copy setlogmask()'s API
 #        _state['conmask'] = mask
 #    return omask
@@ -210,63 +273,100 @@ def setlogmask(mask):
 def openlog(ident=None, option=None, facility=None):
     _update_state(_state, ident=ident, option=option, facility=facility)
 
+def _new_socket():
+    sock = usocket.socket(usocket.AF_INET, usocket.SOCK_DGRAM)
+    sock.setblocking(False) # a slow network should never hold up the caller, we'd rather lose the message
+    return sock
+
 def _close():
     global _sock, _info
-    try: _sock.close()
-    except: pass
+    sock = _sock
     _sock = None
     _info = None
+    if sock is not None:
+        try: sock.close()
+        except OSError: pass
 
 def closelog():
     _close()
     openlog(ident='-', option=0, facility=LOG_USER)
     #TODO: what about logmask (and conmask)? perror?
 
+# the arguments for _EXCEPTION_FORMAT; str() works for any exception, whereas only some have .value
+def _exception_args(e):
+    return (e.__class__.__name__, str(e))
+
 def _internal_exception_log(option, e, msg):
     if option & LOG_CONS:
-        print(_severityprefixes[_INTERNAL_ERROR_SEVERITY] + 'syslog: ' + _EXCEPTION_FORMAT % (e.__class__.__name__, repr(e.value)), msg)
-
-def _syslog4(state, facility, severity, msg):
-    global _info, _sock
-
-    facility = int(state['facility'] if facility == 0 else facility)
-    severity = int(severity)
-    timestamp = state['timestamp'] # sanity-checked later
-    hostname = state['hostname'] # sanity-checked later
-    ident = str(state['ident']).replace(' ','_') #EXTENSION: that .replace()
-    option = int(state['option'])
-#    logmask = int(state['logmask']) # not used in this method, must be checked by caller
-    conmask = int(state['conmask'])
-    perror = state['perror']
+        print(_severityprefixes[_INTERNAL_ERROR_SEVERITY], 'syslog: ', _EXCEPTION_FORMAT % _exception_args(e), msg, sep='')
+
+# copy b into the packet buffer at offset n (silently truncating), and return the new offset
+def _pack(n, b):
+    m = min(len(b), _PACKET_SIZE - n)
+    _packet_mv[n:n+m] = memoryview(b)[:m]
+    return n + m
+
+# if the packet buffer ends part way through a UTF-8 character, return the length without that character
+def _utf8_trim(n):
+    i = n - 1
+    while i > 0 and (_packet[i] & 0xC0) == 0x80: # continuation bytes, so step back to the lead byte
+        i -= 1
+    lead = _packet[i]
+    if lead < 0x80:
+        size = 1
+    elif lead < 0xE0:
+        size = 2
+    elif lead < 0xF0:
+        size = 3
+    else:
+        size = 4
+    return i if i + size > n else n
+
+# the default arguments bind module globals (and builtins) that are used on every call as (faster) locals,
+# they're never meant to be passed
+def _syslog4(state, facility, severity, msg,
+             _severityprefixes=_severityprefixes, _severityprefixes_b=_severityprefixes_b,
+             _priprefixes=_priprefixes, _pack=_pack, _packet_mv=_packet_mv,
+             print=print, len=len):
+    global _info, _info_ticks, _sock
+
+    if facility == 0:
+        facility = state['facility']
+    option = state['option']
+#    logmask = state['logmask'] # not used in this method, must be checked by caller
+    # the other state values are only looked up if they're needed
 
     if option & LOG_PERROR:
         try:
-            perror.write((_severityprefixes[severity] + msg + '\n').encode('utf-8'))
+            perror = state['perror']
+            perror.write(_severityprefixes_b[severity]) # separate writes, rather than concatenating a new string
+            perror.write(msg.encode('utf-8'))
+            perror.write(b'\n')
         except Exception as e:
             _internal_exception_log(option, e, ' in perror.write() callback')
             pass
 
     #EXTENSION: automatically send LOG_CONSOLE and some severities to console
-    if facility == LOG_CONSOLE or (severity & conmask == 0):
-        print(_severityprefixes[severity] + msg)
+    if facility == LOG_CONSOLE or (severity & state['conmask'] == 0):
+        print(_severityprefixes[severity], msg, sep='') # rather than concatenating a new string
 
     if facility == LOG_CONSOLE or _address is False:
         return
 
+    if _info is not None and _dns_ttl_ms and time.ticks_diff(time.ticks_ms(), _info_ticks) > _dns_ttl_ms:
+        _info = None # expired
+
     if _info is None:
         try:
-            #EXTENSION: tuple not required, can just use a string and assume the port number
-            if isinstance(_address, tuple):
-                _info = usocket.getaddrinfo(_address[0], _address[1])[0][-1]
-            else:
-                _info = usocket.getaddrinfo(_address, SYSLOG_UDP_PORT)[0][-1]
+            _info = usocket.getaddrinfo(_address[0], _address[1])[0][-1] # already a (host, port) tuple, see _update_state()
+            _info_ticks = time.ticks_ms()
         except Exception as e:
             _internal_exception_log(option, e, ' in getaddrinfo()')
             return
 
     if _sock is None:
         try:
-            _sock = usocket.socket(usocket.AF_INET, usocket.SOCK_DGRAM)
+            _sock = _new_socket()
         except Exception as e:
             _internal_exception_log(option, e, ' in socket(AF_INET,SOCK_DGRAM)')
             return
@@ -279,6 +379,8 @@ def _syslog4(state, facility, severity, msg):
 #            _internal_exception_log(option, e, ' in hostname() callback')
 #            hostname = ''
 
+    timestamp = state['timestamp'] # sanity-checked below
+
     # In theory, most of this code section will be optimised away. TODO: check this!
     if False:
         pass
@@ -289,6 +391,7 @@ def _syslog4(state, facility, severity, msg):
 #            except Exception as e:
 ##                _internal_exception_log(option, e, ' in timestamp() callback')
 #                timestamp = ''
+#        # NOTE: also needs hostname and ident (with the same checks as _make_header) and no '_header'
 #        if hostname == '':
 #            hostname = '-'
 #        if ident != '':
@@ -296,7 +399,7 @@ def _syslog4(state, facility, severity, msg):
 #        data = '<%d>%s %s %s%s' % (facility|severity, timestamp, hostname, ident, msg)
 #        data = data.encode()
     elif RFC == 5424: # RFC5424
-        if callable(timestamp):
+        if state['_ts_callable']: # worked out when it was set, see _update_state()
             try:
                 timestamp = str(timestamp(state))
                 if int(timestamp[:4]) < 2023: # simple sanity-check; or just check <= 1970 to make sure unix epoch isn't leaking
@@ -306,12 +409,19 @@ def _syslog4(state, facility, severity, msg):
                 timestamp = ''
         if timestamp == '':
             timestamp = '-'
-        if hostname == '':
-            hostname = '-'
-        if ident == '':
-            ident = '-'
-        data = '<%d>1 %s %s %s - - - %s' % (facility|severity, timestamp, hostname, ident, msg)
-        data = data.encode('utf-8')
+        pri = facility|severity
+        prefix = _priprefixes.get(pri)
+        if prefix is None:
+            prefix = _priprefixes[pri] = ('<%d>1 ' % (pri,)).encode('utf-8')
+        n = _pack(0, prefix)
+        n = _pack(n, b'-' if timestamp == '-' else timestamp.encode('utf-8'))
+        n = _pack(n, state['_header'])
+        if len(msg) > _PACKET_SIZE - n: # every character is at least one byte, so don't encode any more than could fit
+            msg = msg[:_PACKET_SIZE - n]
+        n = _pack(n, msg.encode('utf-8'))
+        if n == _PACKET_SIZE: # maybe truncated, so make sure it wasn't in the middle of a (multi-byte) character
+            n = _utf8_trim(n)
+        data = _packet_mv[:n]
     else:
         pass # 'data' is undefined and will throw an exception in the next line
 
@@ -319,22 +429,27 @@ def _syslog4(state, facility, severity, msg):
         _sock.sendto(data, _info)
     except Exception as e:
         _internal_exception_log(option, e, ' in sendto()')
-        # throw away the socket and get a new one next time
-        try: _sock.close()
-        except: pass
-        _sock = None
+        if isinstance(e, OSError) and e.args and e.args[0] in (errno.EAGAIN, errno.ENOMEM):
+            return # transient (e.g. lwIP is out of buffers), so the message is lost but the socket is fine
+        # otherwise throw away the socket (and the address, in case that's what changed) and get new ones next time
+        _close()
 
 #FEATURE: pri is optional in CPython, but required here
 def syslog(pri, msg):
     facility = (pri & ~0x07)
     severity = (pri &  0x07)
 
-    logmask = int(state['logmask'])
+    logmask = _state['logmask']
     if severity & logmask:
         return
 
     _syslog4(_state, facility, severity, msg)
 
+#EXTENSION: like Handler.isEnabledFor(), so callers can skip building a message that syslog() would ignore
+#   if usyslog.isEnabledFor(usyslog.LOG_DEBUG): usyslog.syslog(usyslog.LOG_DEBUG, 'x=%s' % (expensive(),))
+def isEnabledFor(pri):
+    return not ((pri & 0x07) & _state['logmask'])
+
 ######## Implement (part of) the LogHandler API, hopefully just enough to be useful ...
 
 #### LogHandler level constants
@@ -362,8 +477,14 @@ class Handler():
     #EXTENSION: can configure more syslog values per Handler() not just the facility
     def __init__(self, address=None, facility=None, **kwargs):
         self._state = _state.copy()
-        _update_state(self._state, address=address, facility=facility, level=_DEFAULT_LEVEL)
-        _update_state(self._state, **kwargs)
+        if kwargs.get('level') is None:
+            kwargs['level'] = _DEFAULT_LEVEL
+        _update_state(self._state, address=address, facility=facility, **kwargs)
+        self._level = self._state['level'] # checked by every call, so kept as an attribute too
+        global _handlers
+        _handlers += 1
+        self._open = True
+        gc.collect() # tidy up after all that, rather than leaving it for a collection in the middle of logging
 
     #EXTENSION: most useful to switch between LOG_CONSOLE and LOG_SOMETHINGELSE
     def setFacility(self, facility):
@@ -371,35 +492,60 @@ class Handler():
 
     def setLevel(self, level):
         _update_state(self._state, level=level)
+        self._level = self._state['level']
+
+    # so that callers can skip building messages that would be thrown away
+    def isEnabledFor(self, level):
+        return level <= self._level
 
     def close(self):
-        _close()
+        global _handlers
+        if self._open:
+            self._open = False
+            _handlers -= 1
+        if _handlers <= 0:
+            _close()
 
     def log(self, level, msg, *args):
-        if level > self._state['level']:
+        if level > self._level:
             return
-        _syslog4(self._state, 0, level, msg % args)
+        _syslog4(self._state, 0, level, msg % args if args else msg)
 
 #### could split into a seperate sub-class here
 
+    # these check the level themselves and call _syslog4() directly, rather than going through .log()
+    # like .log(), they only format msg if there are args (also as Python does, so a bare '%' is fine)
+
     def debug(self, msg, *args):
-        self.log(DEBUG, msg, *args)
+        if DEBUG > self._level:
+            return
+        _syslog4(self._state, 0, DEBUG, msg % args if args else msg)
 
     def info(self, msg, *args):
-        self.log(INFO, msg, *args)
+        if INFO > self._level:
+            return
+        _syslog4(self._state, 0, INFO, msg % args if args else msg)
 
     #EXTENSION: NOTICE isn't a default LogHandler level
     def notice(self, msg, *args):
-        self.log(NOTICE, msg, *args)
+        if NOTICE > self._level:
+            return
+        _syslog4(self._state, 0, NOTICE, msg % args if args else msg)
 
     def warning(self, msg, *args):
-        self.log(WARNING, msg, *args)
+        if WARNING > self._level:
+            return
+        _syslog4(self._state, 0, WARNING, msg % args if args else msg)
 
     def error(self, msg, *args):
-        self.log(ERROR, msg, *args)
+        if ERROR > self._level:
+            return
+        _syslog4(self._state, 0, ERROR, msg % args if args else msg)
 
     def critical(self, msg, *args):
-        self.log(CRITICAL, msg, *args)
+        if CRITICAL > self._level:
+            return
+        _syslog4(self._state, 0, CRITICAL, msg % args if args else msg)
 
 # rather than create convenience functions for alert/emerg, call .log() directly
 # why not for these, but for notice above? because in the default setup, EMERG and ALERT
@@ -421,6 +567,8 @@ class Handler():
     #   log.exception(e, ' in some_function(%s,%s)', arg1, arg2)    # everything in one log entry
     #   log.exception('some_function(%s,%s) failed', arg1, arg2, e) # no named argument for the simple case
     def exception(self, msg, *args, **kwargs):
+        if _EXCEPTION_LEVEL > self._level:
+            return
         exc_info = kwargs.get('exc_info')
 
         if exc_info is not None: # if 'exc_info' was specified, then proceed as usual
@@ -434,10 +582,10 @@ class Handler():
                 exc = False
         elif isinstance(msg, BaseException): #EXTENSION: exception as the first argument (i.e. 'msg') for everything in one log entry
             if args:
-                self.log(_EXCEPTION_LEVEL, _EXCEPTION_FORMAT + args[0], *((msg.__class__.__name__, repr(msg.value)) + args[1:]))
+                (msg, args) = (_EXCEPTION_FORMAT + args[0], _exception_args(msg) + args[1:])
             else:
-                self.log(_EXCEPTION_LEVEL, _EXCEPTION_FORMAT, *(msg.__class__.__name__, repr(msg.value)))
-            return
+                (msg, args) = (_EXCEPTION_FORMAT, _exception_args(msg))
+            exc = False # already included
         elif args and isinstance(args[-1], BaseException): #EXTENSION: exception as the last argument (i.e. no named argument)
             exc = args[-1]
             args = args[:-1]
@@ -449,5 +597,5 @@ class Handler():
             except: exc = False
 
         self.log(_EXCEPTION_LEVEL, msg, *args)
-        if exc is not False:
-            self.log(_EXCEPTION_LEVEL, _EXCEPTION_FORMAT, exc.__class__.__name__, repr(exc.value))
+        if exc: # i.e. not False, nor None (if sys.exc_info() didn't know)
+            self.log(_EXCEPTION_LEVEL, _EXCEPTION_FORMAT, *_exception_args(exc))